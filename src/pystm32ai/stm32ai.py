@@ -5,17 +5,25 @@ Copyright 2022 - Thibaut Vercueil
 stm32ai module
 Wrapper around stm32ai executable
 """
+import atexit
+import functools
 import tempfile
 import subprocess
 import json
+import mmap
+import hashlib
 import os
 import stat
+import sys
 import platform
 import argparse
-from zipfile import ZipFile
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import shutil
-from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 STM32AI_VERSION = "7.1.0"
 PLATFORM = platform.system().lower()
@@ -24,15 +32,44 @@ if PLATFORM == "darwin":
 
 DIR_PATH = os.path.dirname(__file__)
 EXE_NAME = "stm32ai.exe" if PLATFORM == "windows" else "stm32ai"
-EXE_PATH = os.path.join(DIR_PATH, "exe", STM32AI_VERSION, PLATFORM, EXE_NAME)
+EXE_DIR = os.path.join(DIR_PATH, "exe", STM32AI_VERSION)
+EXE_PATH = os.path.join(EXE_DIR, PLATFORM, EXE_NAME)
 EXE_URL = (
     f"https://sw-center.st.com/packs/x-cube-ai/stm32ai-{PLATFORM}-{STM32AI_VERSION}.zip"
 )
 DLL_EXT = "dll" if PLATFORM == "windows" else "so"
+_DEFAULT_DLL_NAME = f"libai_network.{DLL_EXT}"
+_DEFAULT_DLL_SUBPATH = os.path.join(
+    "inspector_network", "workspace", "lib", _DEFAULT_DLL_NAME
+)
+# Fixed arguments following the executable path in stm32ai command lines
+_ANALYSE_ARGS = ("analyse", "-v", "0")
+_GENERATE_ARGS = ("generate", "-v", "0")
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pystm32ai")
+HASH_CHUNK_SIZE = 1 << 20
+DOWNLOAD_CHUNK_SIZE = 4 << 20
+DOWNLOAD_PARTS = 8
+UNZIP_CHUNK_SIZE = 1 << 20
+
+# Progress bars are only useful on an interactive terminal
+SHOW_PROGRESS = (
+    sys.stderr is not None
+    and sys.stderr.isatty()
+    and os.environ.get("TERM") != "dumb"
+    and not os.environ.get("CI")
+    and not os.environ.get("PYSTM32AI_NO_PROGRESS")
+)
+
+# Set once the executable has been found, so that later calls skip the check
+_EXE_READY = False
 
 
 def analyse(
-    model_path, allocate_inputs=True, allocate_outputs=False, full_report=False
+    model_path,
+    allocate_inputs=True,
+    allocate_outputs=False,
+    full_report=False,
+    use_cache=True,
 ):
     """
     Analyse a model with CubeAI to get info about RAM, ROM and MACC
@@ -41,51 +78,96 @@ def analyse(
         allocate_inputs: whether to allocate input tensor with activations
         allocate_outputs: whether to allocate output tensor with activations
         full_report: Get a full report with per-layers information
+        use_cache: Reuse the report of a previous analysis of the same model,
+            a cached full report keeps the paths and times of the first run
     Returns:
         A report as a dictionary
     """
-    _check_and_download_executable()
+    model_path = _resolve_model_path(model_path)
+    cache_path = (
+        _cache_path(model_path, allocate_inputs, allocate_outputs)
+        if use_cache
+        else None
+    )
+    report = _load_cached_report(cache_path)
+    if report is None:
+        _check_and_download_executable()
+        with tempfile.TemporaryDirectory(dir=_scratch_dir()) as tmp_dir:
+            report = _run_analyse(
+                model_path, tmp_dir, allocate_inputs, allocate_outputs
+            )
+        _store_report(cache_path, report)
 
-    io_options = []
-    if allocate_inputs:
-        io_options.append("--allocate-inputs")
-    if allocate_outputs:
-        io_options.append("--allocate-outputs")
+    if full_report:
+        return report
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        subprocess.run(
-            [
-                EXE_PATH,
-                "analyse",
-                "-m",
-                model_path,
-                "-o",
-                tmp_dir,
-                "-w",
-                tmp_dir,
-                "-v",
-                "0",
-            ]
-            + io_options,
-            check=True,
+    return _summarize_report(report)
+
+
+def analyse_many(
+    model_paths,
+    allocate_inputs=True,
+    allocate_outputs=False,
+    full_report=False,
+    max_workers=None,
+    use_cache=True,
+):
+    """
+    Analyse several models with CubeAI, running the analyses concurrently
+    Args:
+        model_paths: iterable of paths to models (ONNX, h5 or TFLITE)
+        allocate_inputs: whether to allocate input tensor with activations
+        allocate_outputs: whether to allocate output tensor with activations
+        full_report: Get full reports with per-layers information
+        max_workers: maximum number of concurrent stm32ai processes
+            (default number of CPUs)
+        use_cache: Reuse the reports of previous analyses of the same models,
+            cached full reports keep the paths and times of the first run
+    Returns:
+        A list of reports as dictionaries, in the same order as model_paths
+    """
+    model_paths = [_resolve_model_path(model_path) for model_path in model_paths]
+    cache_paths = [
+        _cache_path(model_path, allocate_inputs, allocate_outputs)
+        if use_cache
+        else None
+        for model_path in model_paths
+    ]
+    reports = [_load_cached_report(cache_path) for cache_path in cache_paths]
+    missing = [index for index, report in enumerate(reports) if report is None]
+
+    def _analyse_one(index):
+        # Each model gets its own workspace under the shared parent directory
+        work_dir = os.path.join(tmp_dir, str(index))
+        os.mkdir(work_dir)
+        report = _run_analyse(
+            model_paths[index], work_dir, allocate_inputs, allocate_outputs
         )
-        report_path = os.path.join(tmp_dir, "network_report.json")
-        with open(report_path, "r", encoding="utf-8") as file:
-            report = json.load(file)
+        _store_report(cache_paths[index], report)
+        return report
+
+    if missing:
+        # Done once here rather than in every worker
+        _check_and_download_executable()
+        with tempfile.TemporaryDirectory(
+            dir=_scratch_dir()
+        ) as tmp_dir, ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count()
+        ) as executor:
+            futures = {executor.submit(_analyse_one, index): index for index in missing}
+            try:
+                for future in as_completed(futures):
+                    reports[futures[future]] = future.result()
+            except BaseException:
+                # Don't wait for the queued analyses once one of them failed
+                for future in futures:
+                    future.cancel()
+                raise
 
     if full_report:
-        return report
+        return reports
 
-    return {
-        key: report[key]
-        for key in [
-            "rom_size",
-            "rom_n_macc",
-            "ram_size",
-            "ram_io_size",
-            "model_size",
-        ]
-    }
+    return [_summarize_report(report) for report in reports]
 
 
 def generate(
@@ -105,12 +187,9 @@ def generate(
         output_dir: Path to output directory (default current working directory)
         dll: Generate dynamic library to use the model on host
     """
+    model_path = _resolve_model_path(model_path)
     _check_and_download_executable()
-    io_options = []
-    if allocate_inputs:
-        io_options.append("--allocate-inputs")
-    if allocate_outputs:
-        io_options.append("--allocate-outputs")
+    io_options = _io_options(allocate_inputs, allocate_outputs)
     if name:
         io_options.append("--name")
         name = "".join(name.split()).replace("-", "_")
@@ -118,35 +197,22 @@ def generate(
     if dll:
         io_options.append("--dll")
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        subprocess.run(
-            [
-                EXE_PATH,
-                "generate",
-                "-m",
-                model_path,
-                "-o",
-                output_dir,
-                "-w",
-                tmp_dir,
-                "-v",
-                "0",
-            ]
-            + io_options,
-            check=True,
+    with tempfile.TemporaryDirectory(dir=_scratch_dir()) as tmp_dir:
+        _run_executable(
+            [EXE_PATH, *_GENERATE_ARGS, "-m", model_path, "-o", output_dir]
+            + ["-w", tmp_dir]
+            + io_options
         )
         if dll:
-            net_name = "network" if name == None else name
-            dll_name = f"libai_{net_name}.{DLL_EXT}"
-            shutil.copyfile(
-                os.path.join(
-                    tmp_dir,
-                    f"inspector_{net_name}",
-                    "workspace",
-                    "lib",
-                    dll_name,
-                ),
-                os.path.join(output_dir, dll_name),
+            if name:
+                dll_name = f"libai_{name}.{DLL_EXT}"
+                dll_subpath = os.path.join(
+                    f"inspector_{name}", "workspace", "lib", dll_name
+                )
+            else:
+                dll_name, dll_subpath = _DEFAULT_DLL_NAME, _DEFAULT_DLL_SUBPATH
+            _move_file(
+                os.path.join(tmp_dir, dll_subpath), os.path.join(output_dir, dll_name)
             )
 
 
@@ -164,6 +230,12 @@ def run():
     parser.add_argument("--allocate-inputs", action="store_true", default=True)
     parser.add_argument("--allocate-outputs", action="store_true", default=False)
     parser.add_argument("--full-report", action="store_true")
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Don't reuse the report of a previous analysis",
+    )
     parser.add_argument("--output_dir", default=".")
     parser.add_argument("--name", default=None, help="Name of the model")
     args = vars(parser.parse_args())
@@ -176,68 +248,390 @@ def run():
         print(json.dumps(model_report, indent=4))
     if action == "generate":
         args.pop("full_report")
+        args.pop("use_cache")
         print("Generating C files for model...")
         generate(**args)
         print("Done.")
 
 
+@functools.lru_cache(maxsize=1)
+def _scratch_root():
+    """
+    Create the scratch directory, removed when the process exits
+    Returns:
+        Path of the scratch directory
+    """
+    scratch = tempfile.TemporaryDirectory(prefix="pystm32ai-")
+    atexit.register(scratch.cleanup)
+    return scratch.name
+
+
+def _scratch_dir():
+    """
+    Get a scratch directory shared by all calls for the lifetime of the process,
+    each call creates and removes its own workspace inside it
+    Returns:
+        Path of the scratch directory
+    """
+    scratch_dir = _scratch_root()
+    # A tmp cleaner may have removed it while the process was idle
+    os.makedirs(scratch_dir, exist_ok=True)
+    return scratch_dir
+
+
+def _resolve_model_path(model_path):
+    """
+    Check that a model exists before running anything on it
+    Args:
+        model_path: path to a model (ONNX, h5 or TFLITE)
+    Returns:
+        The absolute path of the model
+    Raises:
+        FileNotFoundError: if the model doesn't exist
+    """
+    model_path = os.path.abspath(os.path.expanduser(os.fspath(model_path)))
+    if not os.path.isfile(model_path):
+        raise FileNotFoundError(f"No such model file: {model_path}")
+    return model_path
+
+
+def _io_options(allocate_inputs, allocate_outputs):
+    """
+    Build the I/O buffers allocation options shared by analyse and generate
+    Args:
+        allocate_inputs: whether to allocate input tensor with activations
+        allocate_outputs: whether to allocate output tensor with activations
+    Returns:
+        A list of command line options
+    """
+    io_options = []
+    if allocate_inputs:
+        io_options.append("--allocate-inputs")
+    if allocate_outputs:
+        io_options.append("--allocate-outputs")
+    return io_options
+
+
+def _run_analyse(model_path, tmp_dir, allocate_inputs, allocate_outputs):
+    """
+    Run stm32ai analyse on a model and load the resulting report
+    Args:
+        model_path: path to a model (ONNX, h5 or TFLITE)
+        tmp_dir: directory used as output and workspace directory
+        allocate_inputs: whether to allocate input tensor with activations
+        allocate_outputs: whether to allocate output tensor with activations
+    Returns:
+        The full report as a dictionary
+    """
+    _run_executable(
+        [EXE_PATH, *_ANALYSE_ARGS, "-m", model_path, "-o", tmp_dir, "-w", tmp_dir]
+        + _io_options(allocate_inputs, allocate_outputs)
+    )
+    return _load_json(os.path.join(tmp_dir, "network_report.json"))
+
+
+def _summarize_report(report):
+    """
+    Keep only the main RAM, ROM and MACC figures of a full report
+    Args:
+        report: full report as returned by stm32ai
+    Returns:
+        A summary report as a dictionary
+    """
+    return {
+        key: report[key]
+        for key in [
+            "rom_size",
+            "rom_n_macc",
+            "ram_size",
+            "ram_io_size",
+            "model_size",
+        ]
+    }
+
+
+def _move_file(src, dst):
+    """
+    Move a file, falling back to a copy when src and dst are on different
+    filesystems
+    Args:
+        src: Path of the file to move
+        dst: Destination path
+    """
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _load_json(path):
+    """
+    Load a JSON file, using orjson when it is installed
+    Args:
+        path: path of the JSON file
+    Returns:
+        The decoded JSON content
+    """
+    with open(path, "rb") as file:
+        if orjson is None:
+            return json.loads(file.read())
+        # orjson can parse straight from the mapped file, without a copy
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                try:
+                    return orjson.loads(view)
+                except orjson.JSONDecodeError:
+                    # orjson rejects the NaN and Infinity values json writes
+                    return json.loads(mapped[:])
+
+
+def _run_executable(args):
+    """
+    Run the stm32ai executable
+    Args:
+        args: command line, starting with the executable path
+    """
+    global _EXE_READY
+    try:
+        # Python file descriptors are non-inheritable by default, so there is
+        # no need to close them in the child, which lets subprocess use the
+        # cheaper posix_spawn instead of fork + exec where available
+        subprocess.run(args, check=True, close_fds=False)
+    except FileNotFoundError:
+        # The executable was removed since it was last checked
+        _EXE_READY = False
+        raise
+
+
+def _cache_path(model_path, allocate_inputs, allocate_outputs):
+    """
+    Get the path of the cached report for a model and analysis options
+    Args:
+        model_path: path to a model (ONNX, h5 or TFLITE)
+        allocate_inputs: whether to allocate input tensor with activations
+        allocate_outputs: whether to allocate output tensor with activations
+    Returns:
+        Path of the report in the cache directory, keyed by the model content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(model_path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    # Options are only tested for truthiness, so any value maps to 0 or 1
+    options = f"{int(bool(allocate_inputs))}:{int(bool(allocate_outputs))}"
+    digest.update(f"{STM32AI_VERSION}:{options}".encode())
+    return os.path.join(CACHE_DIR, f"{digest.hexdigest()}.json")
+
+
+def _load_cached_report(cache_path):
+    """
+    Load a report from the cache
+    Args:
+        cache_path: path of the cached report, or None when caching is disabled
+    Returns:
+        The cached report as a dictionary, None if not in cache
+    """
+    if cache_path is None:
+        return None
+    try:
+        return _load_json(cache_path)
+    except (OSError, ValueError):
+        return None
+
+
+def _store_report(cache_path, report):
+    """
+    Store a report in the cache, the file is replaced atomically so that
+    concurrent readers never see a partially written report. Caching is best
+    effort, a cache directory that can't be written to is ignored
+    Args:
+        cache_path: path of the cached report, or None when caching is disabled
+        report: full report as returned by stm32ai
+    """
+    if cache_path is None:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(report, file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def _check_and_download_executable():
     """
     Checks for the stm32ai executable and downloads it if it doesn't exist
     """
+    global _EXE_READY
+    if _EXE_READY:
+        return
     if os.path.exists(EXE_PATH):
+        _EXE_READY = True
         return
     print("Didn't find stm32ai executable, downloading it")
     # Create a directory with cubeAI version under exe directory
-    try:
-        os.mkdir(os.path.join(DIR_PATH, "exe", STM32AI_VERSION))
-    except OSError:
-        ...
+    os.makedirs(EXE_DIR, exist_ok=True)
 
     # Download the file in a temporary directory and unzip it
     with tempfile.TemporaryDirectory() as tmp_dir:
         zip_path = os.path.join(tmp_dir, "stm32ai.zip")
         _download(EXE_URL, zip_path)
-        _unzip(zip_path, os.path.join(DIR_PATH, "exe", STM32AI_VERSION))
+        _unzip(zip_path, EXE_DIR, progress=True)
 
     os.chmod(EXE_PATH, stat.S_IREAD | stat.S_IWRITE | stat.S_IEXEC)
+    _EXE_READY = True
 
 
 def _download(url, fname):
     """
-    Utility function to download a file
+    Utility function to download a file, in parallel byte ranges when the
+    server supports it
     Args:
         url: URL of the file to be downloaded
         fname: Path of the file to be downloaded
     """
-    resp = requests.get(url, stream=True)
-    total = int(resp.headers.get("content-length", 0))
-    with open(fname, "wb") as file, tqdm(
-        desc=fname,
-        total=total,
-        unit="iB",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as tqbar:
-        for data in resp.iter_content(chunk_size=1024):
-            size = file.write(data)
-            tqbar.update(size)
+    # Only needed to install the executable, imported here to keep the module
+    # import light
+    import urllib.request
+    from tqdm import tqdm
+
+    # Asking for the first byte tells whether ranges are supported and the
+    # total size, a server that ignores it sends the whole file instead
+    context = _ssl_context()
+    probe = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    resp = urllib.request.urlopen(probe, context=context)
+    size = resp.headers.get("Content-Range", "").rpartition("/")[2]
+    if resp.status == 206 and not size.isdigit():
+        # Ranges are supported but the total size is unknown ("bytes 0-0/*"),
+        # the probe only holds the first byte so fetch the whole file instead
+        resp.close()
+        resp = urllib.request.urlopen(url, context=context)
+    with resp:
+        ranged = resp.status == 206
+        total = int(size if ranged else resp.headers.get("Content-Length", 0))
+        with open(fname, "wb") as file, tqdm(
+            desc=fname,
+            total=total,
+            unit="iB",
+            unit_scale=True,
+            unit_divisor=1024,
+            disable=not SHOW_PROGRESS,
+        ) as tqbar:
+            if not ranged:
+                _copy_response(resp, file, tqbar)
+                return
+
+            # Preallocate the file so that each range can be written at its offset
+            file.truncate(total)
+            part_size = -(-total // DOWNLOAD_PARTS)
+            ranges = [
+                (start, min(start + part_size, total) - 1)
+                for start in range(0, total, part_size)
+            ]
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        _download_range, url, fname, start, end, tqbar, context
+                    )
+                    for start, end in ranges
+                ]
+                for future in futures:
+                    future.result()
 
 
-def _unzip(fname, directory):
+def _ssl_context():
+    """
+    Utility function to get the TLS context used for downloads, trusting the
+    certifi bundle when it is installed as some Python builds (e.g. python.org
+    macOS installers) have no usable system certificates
+    Returns:
+        An SSL context, None to use the default one
+    """
+    try:
+        import certifi
+    except ImportError:
+        return None
+    import ssl
+
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+def _download_range(url, fname, start, end, tqbar, context=None):
+    """
+    Utility function to download a byte range of a file in place
+    Args:
+        url: URL of the file to be downloaded
+        fname: Path of the preallocated file to write to
+        start: First byte of the range
+        end: Last byte of the range (inclusive)
+        tqbar: Progress bar to update
+        context: SSL context to use for the request
+    """
+    import urllib.request
+
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+    with urllib.request.urlopen(request, context=context) as resp:
+        if resp.status != 206:
+            raise RuntimeError(f"Server didn't honour range request for {url}")
+        with open(fname, "r+b") as file:
+            file.seek(start)
+            _copy_response(resp, file, tqbar)
+
+
+def _copy_response(resp, file, tqbar):
+    """
+    Utility function to copy the body of a response to a file
+    Args:
+        resp: Response to read from
+        file: File object to write to
+        tqbar: Progress bar to update
+    """
+    from tqdm.utils import CallbackIOWrapper
+
+    shutil.copyfileobj(
+        CallbackIOWrapper(tqbar.update, resp, "read"),
+        file,
+        length=DOWNLOAD_CHUNK_SIZE,
+    )
+
+
+def _unzip(fname, directory, progress=False):
     """
     Utility function to unzip a file
     Args:
         fname: Name of the file to be unzipped
         directory: Directory to unzip
+        progress: Show a progress bar based on the uncompressed size
     """
+    from zipfile import ZipFile
+    from tqdm import tqdm
+
+    directory = os.path.realpath(directory)
     with ZipFile(file=fname) as zip_file:
-        for file in tqdm(
+        members = zip_file.infolist()
+        with tqdm(
             desc="Unzipping",
-            iterable=zip_file.namelist(),
-            total=len(zip_file.namelist()),
-        ):
-            zip_file.extract(member=file, path=directory)
+            total=sum(info.file_size for info in members),
+            unit="iB",
+            unit_scale=True,
+            unit_divisor=1024,
+            disable=not (progress and SHOW_PROGRESS),
+        ) as tqbar:
+            for info in members:
+                target = os.path.realpath(os.path.join(directory, info.filename))
+                if os.path.commonpath([directory, target]) != directory:
+                    raise ValueError(f"Unsafe path in archive: {info.filename}")
+                if info.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zip_file.open(info) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, length=UNZIP_CHUNK_SIZE)
+                tqbar.update(info.file_size)
 
 
 if __name__ == "__main__":
@@ -3,25 +3,127 @@ SPDX-License-Identifier: MIT
 stm32ai module
 Wrapper around stm32ai executable
 """
+import math
 import os
+import re
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile
+import pytest
 from src.pystm32ai import __version__
+from src.pystm32ai import stm32ai
 from src.pystm32ai.stm32ai import analyse
+from src.pystm32ai.stm32ai import analyse_many
 from src.pystm32ai.stm32ai import generate
 
 DIR_PATH = os.path.dirname(__file__)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep the tests away from the user's report cache
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(stm32ai, "CACHE_DIR", cache_dir)
+    return cache_dir
+
+
 def test_version():
     assert __version__ == "0.1.0"
 
 
 def test_analyse_model():
-    report = analyse(os.path.join(DIR_PATH, "model_quant.tflite"))
+    report = analyse(os.path.join(DIR_PATH, "model_quant.tflite"), use_cache=False)
     assert report["model_size"] == 220884
     assert report["rom_n_macc"] == 13421668
 
 
+def test_analyse_model_cached(cache_dir):
+    model_path = os.path.join(DIR_PATH, "model_quant.tflite")
+    report = analyse(model_path)
+    assert len(os.listdir(cache_dir)) == 1
+    assert analyse(model_path) == report
+    assert analyse(model_path, use_cache=False) == report
+
+
+def test_cache_path_non_bool_options():
+    model_path = os.path.join(DIR_PATH, "model_quant.tflite")
+    assert stm32ai._cache_path(model_path, 1, None) == stm32ai._cache_path(
+        model_path, True, False
+    )
+    report = analyse(model_path, allocate_outputs=None)
+    assert report["model_size"] == 220884
+
+
+def test_analyse_model_unwritable_cache(monkeypatch):
+    monkeypatch.setattr(stm32ai, "CACHE_DIR", os.path.join(__file__, "cache"))
+    report = analyse(os.path.join(DIR_PATH, "model_quant.tflite"))
+    assert report["model_size"] == 220884
+
+
+def test_analyse_removed_scratch_dir():
+    shutil.rmtree(stm32ai._scratch_dir())
+    report = analyse(os.path.join(DIR_PATH, "model_quant.tflite"), use_cache=False)
+    assert report["model_size"] == 220884
+
+
+def test_analyse_missing_model():
+    with pytest.raises(FileNotFoundError):
+        analyse(os.path.join(DIR_PATH, "missing.tflite"), use_cache=False)
+
+
+def test_analyse_many_stops_on_failure(tmp_path, monkeypatch):
+    model_path = os.path.join(DIR_PATH, "model_quant.tflite")
+    slow_model_path = str(tmp_path / "slow.tflite")
+    bad_model_path = str(tmp_path / "bad.tflite")
+    shutil.copyfile(model_path, slow_model_path)
+    with open(bad_model_path, "wb") as file:
+        file.write(b"not a model")
+    analysed = []
+
+    def run_analyse(model_path, tmp_dir, allocate_inputs, allocate_outputs):
+        if model_path == bad_model_path:
+            raise subprocess.CalledProcessError(1, "stm32ai")
+        time.sleep(0.5 if model_path == slow_model_path else 0.05)
+        analysed.append(model_path)
+        return {}
+
+    monkeypatch.setattr(stm32ai, "_check_and_download_executable", lambda: None)
+    monkeypatch.setattr(stm32ai, "_run_analyse", run_analyse)
+    # The failure is raised as soon as it happens, not after the slow model
+    # queued before it, and the models still queued are not analysed
+    with pytest.raises(subprocess.CalledProcessError):
+        analyse_many(
+            [slow_model_path, bad_model_path] + [model_path] * 10,
+            max_workers=2,
+            use_cache=False,
+        )
+    assert len(analysed) < 5
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_load_json_non_finite(tmp_path, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(stm32ai, "orjson", None)
+    path = tmp_path / "network_report.json"
+    path.write_text('{"rom_size": NaN, "ram_size": Infinity}')
+    report = stm32ai._load_json(str(path))
+    assert math.isnan(report["rom_size"])
+    assert report["ram_size"] == math.inf
+
+
+def test_analyse_many_models():
+    model_path = os.path.join(DIR_PATH, "model_quant.tflite")
+    reports = analyse_many([model_path, model_path], max_workers=2, use_cache=False)
+    assert len(reports) == 2
+    for report in reports:
+        assert report["model_size"] == 220884
+        assert report["rom_n_macc"] == 13421668
+
+
 def test_generate_model():
     with tempfile.TemporaryDirectory() as tmp_dir:
         generate(os.path.join(DIR_PATH, "model_quant.tflite"), output_dir=tmp_dir)
@@ -46,3 +148,76 @@ def test_generate_dll_with_name():
             dll=True,
         )
         assert os.path.exists(os.path.join(tmp_dir, "libai_bobby.so"))
+
+
+@pytest.fixture(params=["ranges", "no-ranges", "unknown-length"])
+def http_server(request):
+    data = os.urandom((1 << 20) + 3)
+    mode = request.param
+    seen_requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = data
+            match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+            seen_requests.append(self.headers.get("Range"))
+            if mode != "no-ranges" and match:
+                start, end = map(int, match.groups())
+                body = data[start : end + 1]
+                total = len(data) if mode == "ranges" else "*"
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/stm32ai.zip"
+    yield url, data, mode, seen_requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_download(http_server, tmp_path):
+    url, data, mode, seen_requests = http_server
+    fname = str(tmp_path / "stm32ai.zip")
+    stm32ai._download(url, fname)
+    with open(fname, "rb") as file:
+        assert file.read() == data
+    # The probe, then one request per part when ranges are supported or a
+    # plain request when the total size is unknown
+    expected = {
+        "ranges": 1 + stm32ai.DOWNLOAD_PARTS,
+        "no-ranges": 1,
+        "unknown-length": 2,
+    }
+    assert len(seen_requests) == expected[mode]
+
+
+def test_unzip(tmp_path):
+    zip_path = str(tmp_path / "stm32ai.zip")
+    data = os.urandom((1 << 20) + 3)
+    with ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("linux/", "")
+        zip_file.writestr("linux/stm32ai", data)
+        zip_file.writestr("linux/lib/libai.so", b"lib")
+    out_dir = tmp_path / "out"
+    stm32ai._unzip(zip_path, str(out_dir), progress=True)
+    assert (out_dir / "linux" / "stm32ai").read_bytes() == data
+    assert (out_dir / "linux" / "lib" / "libai.so").read_bytes() == b"lib"
+
+
+def test_unzip_unsafe_path(tmp_path):
+    zip_path = str(tmp_path / "stm32ai.zip")
+    with ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("../escaped", b"data")
+    with pytest.raises(ValueError):
+        stm32ai._unzip(zip_path, str(tmp_path / "out"))
+    assert not (tmp_path / "escaped").exists()